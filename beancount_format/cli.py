@@ -1,48 +1,485 @@
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
 import io
+import json
+import mmap
+import os
 import pathlib
+import queue
 import sys
-from collections.abc import Generator, Sequence
+import threading
+import typing
+from collections.abc import Generator, Iterable, Sequence
 
 import click
-from beancount_parser.parser import make_parser
+import lark
+from beancount_parser.parser import BEANCOUNT_GRAMMAR_FILE, make_parser
+from lark import Lark
 
-from beancount_format.format import Formatter
+from beancount_format import format as format_module
+from beancount_format.format import Formatter, chunks
 
+BEAN_SUFFIX = ".bean"
 
-def __input_files(paths: Sequence[pathlib.Path]) -> Generator[pathlib.Path, None, None]:
-    for p in paths:
-        if p.is_file():
-            yield p
-        else:
-            yield from __input_files(p.iterdir())
+# files larger than this are read through mmap instead of a buffered read
+MMAP_THRESHOLD = 256 * 1024
 
+# files handed to a worker process at once
+CHUNK_SIZE = 8
 
-@click.command
-@click.argument("path", nargs=-1, type=click.Path(path_type=pathlib.Path))
-@click.option("--indent", default=4, type=int)
-def main(path, indent: int):
-    parser = make_parser()
-    formatter = Formatter(indent_width=indent)
+# how many files are read ahead of the formatter when formatting sequentially
+PREFETCH_DEPTH = 4
 
-    exit_code = 0
+# most recently used entries kept in the formatted file index
+MAX_CACHE_ENTRIES = 10000
+
+# built lazily, once per process (including each worker of the pool)
+_parser: typing.Optional[Lark] = None
+_clean_keys: typing.Optional[typing.Set[str]] = None
+
+
+def _get_parser(use_cache: bool) -> Lark:
+    global _parser  # noqa: PLW0603
+    if _parser is None:
+        if not use_cache:
+            _parser = make_parser()
+            return _parser
+        # lark stores the compiled grammar there and checks it against a hash of
+        # grammar and options, so new processes load it instead of compiling it.
+        grammar_cache = _grammar_cache_file()
+        with contextlib.suppress(OSError):
+            grammar_cache.parent.mkdir(parents=True, exist_ok=True)
+        _parser = make_parser(cache=str(grammar_cache))
+    return _parser
+
+
+def _cache_dir() -> pathlib.Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return pathlib.Path(cache_home, "beancount-format")
+
+
+def _cache_file() -> pathlib.Path:
+    """Index of files that are known to be formatted."""
+    return _cache_dir() / "formatted.json"
+
+
+def _grammar_cache_file() -> pathlib.Path:
+    """Compiled grammar, pickled by lark."""
+    return _cache_dir() / "grammar.lark"
+
+
+def _load_cache() -> typing.List[str]:
+    """Keys of the formatted file index, least recently used first."""
+    try:
+        with _cache_file().open("rb") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return []
+    if not isinstance(data, dict):
+        return []
+    return [key for key, value in data.items() if value == "clean"]
+
+
+def _load_clean_keys() -> None:
+    global _clean_keys  # noqa: PLW0603
+    _clean_keys = set(_load_cache())
+
+
+def _get_clean_keys() -> typing.Set[str]:
+    if _clean_keys is None:
+        _load_clean_keys()
+    assert _clean_keys is not None
+    return _clean_keys
+
+
+def _save_cache(used_keys: typing.Set[str]) -> None:
+    """Add ``used_keys`` to the index as most recently used, drop the oldest.
 
-    for file in __input_files(path):
-        if file.suffix.lower() not in {".bean"}:
+    The index is only rewritten when there are new keys,
+    a run that only hits the cache doesn't write anything.
+    """
+    keys = _load_cache()
+    if used_keys.issubset(keys):
+        return
+    keys = [key for key in keys if key not in used_keys] + sorted(used_keys)
+    keys = keys[-MAX_CACHE_ENTRIES:]
+    cache_file = _cache_file()
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(dict.fromkeys(keys, "clean")))
+        os.replace(tmp, cache_file)
+    except OSError as e:
+        print("failed to write cache file", cache_file, e)
+
+
+@functools.lru_cache(maxsize=None)
+def _formatter_fingerprint() -> bytes:
+    """Hash of the code that decides the output.
+
+    Part of every cache key, so entries written by another version of the
+    formatter, including an edited source checkout, never match.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for file in (__file__, format_module.__file__, BEANCOUNT_GRAMMAR_FILE):
+        with open(file, "rb") as f:
+            h.update(f.read())
+    h.update(lark.__version__.encode())
+    return h.digest()
+
+
+def _cache_key(content: "typing.Union[bytes, mmap.mmap]", indent: int) -> str:
+    """Hash of file content, formatter code and options."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(_formatter_fingerprint())
+    h.update(f"{indent}\0".encode())
+    h.update(content)
+    return h.hexdigest()
+
+
+def _is_bean_file(name: str) -> bool:
+    # same as ``Path(name).suffix.lower() == ".bean"``, but only lowers the tail,
+    # a bare ".bean" is a dotfile without suffix.
+    n = len(BEAN_SUFFIX)
+    return len(name) > n and name[-n:].lower() == BEAN_SUFFIX
+
+
+def _first_visit(
+    key: typing.Tuple[int, int], seen: typing.Set[typing.Tuple[int, int]]
+) -> bool:
+    """Record ``(st_dev, st_ino)``, return ``False`` if it was seen before."""
+    if not key[1]:
+        # filesystem without inode numbers, can't tell
+        return True
+    if key in seen:
+        return False
+    seen.add(key)
+    return True
+
+
+def _stat_id(path: str) -> typing.Tuple[int, int]:
+    st = os.stat(path)
+    return st.st_dev, st.st_ino
+
+
+def _entry_id(entry: "os.DirEntry[str]", dev: int) -> typing.Tuple[int, int]:
+    """Identity of a file found in a directory on device ``dev``."""
+    if entry.is_symlink():
+        # ``inode()`` is the one of the link itself
+        return _stat_id(entry.path)
+    return dev, entry.inode()
+
+
+def __input_files(paths: Sequence[pathlib.Path]) -> Generator[str, None, None]:
+    """Yield ``.bean`` files in ``paths``, walking directories depth first.
+
+    Walk with a stack of ``os.scandir`` iterators instead of recursion,
+    ``DirEntry`` already knows its type so most entries don't need a ``stat``.
+    Each directory is entered once, so symlink loops don't grow the stack,
+    and each file is yielded once, even if it's reachable by several paths.
+    """
+    seen_dirs: typing.Set[typing.Tuple[int, int]] = set()
+    seen_files: typing.Set[typing.Tuple[int, int]] = set()
+    for p in paths:
+        path = os.fspath(p)
+        if os.path.isfile(path):
+            if _is_bean_file(os.path.basename(path)) and _first_visit(
+                _stat_id(path), seen_files
+            ):
+                yield path
+            continue
+        dev, ino = _stat_id(path)
+        if not _first_visit((dev, ino), seen_dirs):
             continue
+
+        # pathlib drops a leading "./", scandir keeps it in ``DirEntry.path``
+        strip = len(os.curdir + os.sep) if path == os.curdir else 0
+        stack = [(os.scandir(path), dev)]
         try:
-            input_content = file.read_text(encoding="utf-8")
-            tree = parser.parse(input_content)
-            output_file = io.StringIO()
-            with output_file:
-                formatter.format(tree, output_file)
-                formatted = output_file.getvalue()
-            if input_content == formatted:
+            while stack:
+                it, dev = stack[-1]
+                for entry in it:
+                    if entry.is_file():
+                        if _is_bean_file(entry.name) and _first_visit(
+                            _entry_id(entry, dev), seen_files
+                        ):
+                            yield entry.path[strip:]
+                    elif entry.is_dir():
+                        key = _stat_id(entry.path)
+                        if _first_visit(key, seen_dirs):
+                            stack.append((os.scandir(entry.path), key[0]))
+                            break
+                else:
+                    stack.pop()[0].close()
+        finally:
+            for it, _ in stack:
+                it.close()
+
+
+def _decode(content: "typing.Union[bytes, mmap.mmap]") -> str:
+    """Decode as utf-8 with universal newlines, like ``Path.read_text``."""
+    text = str(content, "utf-8")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def _write_bytes(file: str, content: bytes) -> None:
+    fd = os.open(file, os.O_WRONLY | os.O_TRUNC | getattr(os, "O_BINARY", 0))
+    try:
+        view = memoryview(content)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+
+
+class Result(typing.NamedTuple):
+    file: str
+    changed: bool
+    # as string, so the result can always be pickled back from a worker process
+    error: typing.Optional[str] = None
+    # cache key of a file that is formatted, either found in or new to the index
+    clean_key: typing.Optional[str] = None
+
+
+class _Source(typing.NamedTuple):
+    file: str
+    # ``None`` if file is known to be formatted already
+    content: typing.Optional[str]
+    clean_key: typing.Optional[str]
+
+
+def _load(file: str, indent: int, use_cache: bool) -> _Source:
+    """Read file once, check it against the cache and decode it."""
+    fd = os.open(file, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        if os.fstat(fd).st_size <= MMAP_THRESHOLD:
+            # unbuffered, readall() sizes its buffer from fstat and reads in C
+            with open(fd, "rb", buffering=0, closefd=False) as f:
+                return _source(file, f.readall(), indent, use_cache)
+        # hash and decode straight from the mapping, without copying it into bytes
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+            return _source(file, mm, indent, use_cache)
+    finally:
+        os.close(fd)
+
+
+def _source(
+    file: str, content: "typing.Union[bytes, mmap.mmap]", indent: int, use_cache: bool
+) -> _Source:
+    key: typing.Optional[str] = None
+    if use_cache:
+        key = _cache_key(content, indent)
+        if key in _get_clean_keys():
+            return _Source(file, content=None, clean_key=key)
+    return _Source(file, content=_decode(content), clean_key=key)
+
+
+def _format_source(source: _Source, indent: int, use_cache: bool) -> Result:
+    """Format a loaded file and write it back if it changed."""
+    file, input_content, key = source
+    if input_content is None:
+        return Result(file, changed=False, clean_key=key)
+    try:
+        tree = _get_parser(use_cache).parse(input_content)
+        # formatter grows its column widths while formatting,
+        # use a fresh one so output doesn't depend on other files.
+        formatter = Formatter(indent_width=indent)
+        output_file = io.StringIO()
+        with output_file:
+            formatter.format(tree, output_file)
+            formatted = output_file.getvalue()
+        if input_content == formatted:
+            return Result(file, changed=False, clean_key=key)
+        _write_bytes(file, formatted.encode("utf-8"))
+        return Result(file, changed=True)
+    except Exception as e:
+        return Result(file, changed=False, error=str(e))
+
+
+def _format_one(file: str, indent: int, use_cache: bool) -> Result:
+    """Format a single file in place."""
+    try:
+        source = _load(file, indent, use_cache)
+    except Exception as e:
+        return Result(file, changed=False, error=str(e))
+    return _format_source(source, indent, use_cache)
+
+
+def _format_many(
+    files: Sequence[str], indent: int, use_cache: bool
+) -> typing.List[Result]:
+    """Format files in order, stop after the first failure."""
+    results: typing.List[Result] = []
+    for file in files:
+        result = _format_one(file, indent, use_cache)
+        results.append(result)
+        if result.error is not None:
+            break
+    return results
+
+
+def _until_failure(results: Iterable[Result]) -> Generator[Result, None, None]:
+    """Stop after the first failed file, files after it are left untouched."""
+    for result in results:
+        yield result
+        if result.error is not None:
+            return
+
+
+def _pool_results(
+    futures: Sequence["concurrent.futures.Future[typing.List[Result]]"],
+) -> Generator[Result, None, None]:
+    """Yield results of ``futures`` in order.
+
+    After the first failure, chunks that haven't started are cancelled.
+    Chunks that already ran may have written files, so their results are still
+    yielded.
+    """
+    failed = False
+    for future in futures:
+        if future.cancelled():
+            continue
+        for result in future.result():
+            yield result
+            if result.error is not None and not failed:
+                failed = True
+                for f in futures:
+                    f.cancel()
+
+
+def _format_prefetched(
+    files: Sequence[str], indent: int, use_cache: bool
+) -> Generator[Result, None, None]:
+    """Format files in order, while a thread reads the next ones.
+
+    Reading releases the GIL, so disk I/O overlaps with parsing and formatting.
+    The queue is bounded, at most ``PREFETCH_DEPTH`` files are held in memory.
+    """
+    q: "queue.Queue[typing.Union[_Source, Result, None]]" = queue.Queue(PREFETCH_DEPTH)
+    stop = threading.Event()
+
+    def put(item: typing.Union[_Source, Result, None]) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
                 continue
-            print("formatting", file)
-            file.write_bytes(formatted.encode("utf-8"))
+        return False
+
+    def reader() -> None:
+        for file in files:
+            try:
+                item: typing.Union[_Source, Result] = _load(file, indent, use_cache)
+            except Exception as e:
+                item = Result(file, changed=False, error=str(e))
+            if not put(item):
+                return
+        put(None)
+
+    thread = threading.Thread(target=reader, name="beancount-format-reader")
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            if isinstance(item, Result):
+                yield item
+            else:
+                yield _format_source(item, indent, use_cache)
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _report(results: Iterable[Result], clean_keys: typing.Set[str]) -> int:
+    """Print results in order and return exit code.
+
+    Cache keys of clean files are added to ``clean_keys``.
+    """
+    exit_code = 0
+    for result in results:
+        if result.error is not None:
+            print("failed to format file", result.file, result.error)
             exit_code = 1
-        except Exception as e:
-            print("failed to format file", file, e)
-            return 1
+            continue
+        if result.clean_key is not None:
+            clean_keys.add(result.clean_key)
+        if result.changed:
+            print("formatting", result.file)
+            exit_code = 1
+    return exit_code
+
+
+def _usable_cpus() -> int:
+    """CPUs this process may run on, respecting affinity like ``taskset``."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+@click.command
+@click.argument("path", nargs=-1, type=click.Path(path_type=pathlib.Path))
+@click.option("--indent", default=4, type=int)
+@click.option(
+    "--jobs",
+    "-j",
+    default=None,
+    type=click.IntRange(min=1),
+    help="number of worker processes, 1 to format files sequentially "
+    "[default: usable CPUs]",
+)
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    help="skip files that are known to be formatted already",
+)
+def main(
+    path: typing.Tuple[pathlib.Path, ...],
+    indent: int,
+    jobs: typing.Optional[int],
+    cache: bool,
+) -> None:
+    files = list(__input_files(path))
+    if jobs is None:
+        jobs = _usable_cpus()
+    if cache:
+        # loaded before the pool starts, so forked workers inherit both
+        _formatter_fingerprint()
+        _load_clean_keys()
+    format_one = functools.partial(_format_one, indent=indent, use_cache=cache)
+    clean_keys: typing.Set[str] = set()
+
+    if len(files) <= 1:
+        exit_code = _report(_until_failure(map(format_one, files)), clean_keys)
+    elif jobs == 1 or len(files) <= CHUNK_SIZE:
+        # a single chunk can't be spread over workers, don't pay for the pool
+        with contextlib.closing(
+            _format_prefetched(files, indent=indent, use_cache=cache)
+        ) as results:
+            exit_code = _report(_until_failure(results), clean_keys)
+    else:
+        # forked workers inherit the parser, spawned ones load the grammar cache
+        _get_parser(cache)
+        file_chunks = list(chunks(files, CHUNK_SIZE))
+        # no more workers than chunks, forking idle ones only costs startup time
+        workers = min(jobs, len(file_chunks))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_format_many, chunk, indent, cache)
+                for chunk in file_chunks
+            ]
+            exit_code = _report(_pool_results(futures), clean_keys)
+
+    if cache:
+        _save_cache(clean_keys)
 
-    return sys.exit(exit_code)
+    sys.exit(exit_code)
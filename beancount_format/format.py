@@ -8,6 +8,8 @@ import typing
 
 from lark import ParseTree, Token, Tree
 
+T = typing.TypeVar("T")
+
 VERBOSE_LOG_LEVEL = logging.NOTSET + 1
 
 COMMENT_PREFIX = re.compile("[;*]+")
@@ -79,9 +81,9 @@ SIMPLE_DIRECTIVE_ENTRY_TYPES = {
 def get_entry_type(statement: Tree) -> EntryType:
     first_child: Tree = statement.children[0]
     if first_child.data == "date_directive":
-        return DATE_DIRECTIVE_ENTRY_TYPES[first_child.children[0].data.value]
+        return DATE_DIRECTIVE_ENTRY_TYPES[first_child.children[0].data]
     if first_child.data == "simple_directive":
-        return SIMPLE_DIRECTIVE_ENTRY_TYPES[first_child.children[0].data.value]
+        return SIMPLE_DIRECTIVE_ENTRY_TYPES[first_child.children[0].data]
     raise ValueError(f"Unexpected first child type {first_child.data}")
 
 
@@ -122,7 +124,7 @@ class Collector:
         self.header_comments: typing.List[Token] = []
         self.statement_groups: typing.List[StatementGroup] = []
 
-    def collect(self, tree: Tree):
+    def collect(self, tree: Tree) -> None:
         self.logger.info("Collecting")
         if tree.data != "start":
             raise ValueError("Expected start")
@@ -131,7 +133,7 @@ class Collector:
                 continue
             self.statement(child)
 
-    def statement(self, tree: Tree):
+    def statement(self, tree: Tree) -> None:
         if tree.data != "statement":
             raise ValueError("Expected statement")
         self.logger.debug("Collecting statement at line %s", tree.meta.line)
@@ -153,7 +155,7 @@ class Collector:
             )
         self.statement_groups[-1].statements.append(tree)
 
-    def section_header_token(self, token: Token):
+    def section_header_token(self, token: Token) -> None:
         self.logger.debug(
             "New statement group for %r at line %s", token.value, token.line
         )
@@ -171,13 +173,13 @@ class Collector:
         return True
 
 
-def chunks(lst, n):
+def chunks(lst: typing.Sequence[T], n: int) -> typing.Iterator[typing.Sequence[T]]:
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lst), n):
         yield lst[i : i + n]
 
 
-def format_number(d: decimal.Decimal, n: int = 3):
+def format_number(d: decimal.Decimal, n: int = 3) -> str:
     ss = str(d)
 
     a, _, b = ss.partition(".")
@@ -198,6 +200,8 @@ def format_number(d: decimal.Decimal, n: int = 3):
 
 
 class Formatter:
+    __slots__ = ("account_width", "indent", "indent_width", "logger", "number_width")
+
     def __init__(
         self,
         indent_width: int = DEFAULT_INDENT_WIDTH,
@@ -207,6 +211,8 @@ class Formatter:
         logger: typing.Optional[logging.Logger] = None,
     ):
         self.indent_width: int = indent_width
+        # indent prefix, built once instead of for every indented line
+        self.indent: str = " " * indent_width
         self.account_width: int = min_account_width
         self.number_width: int = min_number_width
         # self.num_sep_width: int = num_sep_width
@@ -407,7 +413,7 @@ class Formatter:
         if tree.data != "simple_directive":
             raise ValueError("Expected a simple directive")
         first_child = tree.children[0]
-        items: typing.List[str] = [first_child.data.value] + [
+        items: typing.List[str] = [first_child.data] + [
             child.value for child in first_child.children if child is not None
         ]
         return " ".join(items)
@@ -417,7 +423,7 @@ class Formatter:
             raise ValueError("Expected a date directive")
         first_child = tree.children[0]
         date = first_child.children[0].value
-        directive_type = first_child.data.value
+        directive_type = first_child.data
         if directive_type == "txn":
             columns: typing.List[str] = [date]
             flag, payee, narration, annotations = first_child.children[1:]
@@ -521,7 +527,7 @@ class Formatter:
             lines.append(line)
             metadata_lines = self.format_metadata_lines(posting.metadata)
             for metadata_line in metadata_lines:
-                lines.append(" " * self.indent_width + metadata_line)
+                lines.append(self.indent + metadata_line)
         return lines
 
     def format_entry(self, entry: Entry) -> str:
@@ -545,10 +551,10 @@ class Formatter:
                 lines.append(line)
                 metadata_lines = self.format_metadata_lines(entry.metadata)
                 for metadata_line in metadata_lines:
-                    lines.append(" " * self.indent_width + metadata_line)
+                    lines.append(self.indent + metadata_line)
                 posting_lines = self.format_posting_lines(entry.postings)
                 for posting_line in posting_lines:
-                    lines.append(" " * self.indent_width + posting_line)
+                    lines.append(self.indent + posting_line)
             else:
                 line = self.format_simple_directive(first_child)
                 tail_comment = entry.statement.children[1]
@@ -606,7 +612,7 @@ class Formatter:
 
         return "\n\n".join(sections)
 
-    def calculate_column_widths(self, tree: ParseTree):
+    def calculate_column_widths(self, tree: ParseTree) -> None:
         self.logger.info("Calculate column width")
         for statement in tree.children:
             if statement is None:
@@ -638,7 +644,7 @@ class Formatter:
                 width = len(self.format_number_expr(amount.children[0]))
                 self.number_width = max(width, self.number_width)
 
-    def format(self, tree: ParseTree, output_file: io.TextIOBase):
+    def format(self, tree: ParseTree, output_file: io.TextIOBase) -> None:
         if tree.data != "start":
             raise ValueError("expected start as the root rule")
         self.calculate_column_widths(tree)
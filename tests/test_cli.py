@@ -0,0 +1,201 @@
+import json
+import pathlib
+import typing
+
+import pytest
+from click.testing import CliRunner, Result
+
+from beancount_format import cli
+
+
+def ledger(account: str = "Assets:Bank") -> str:
+    return f"""2020-01-01 open {account} EUR
+2020-02-02 * "Pay"
+  {account}  1000 EUR
+  Income:Salary
+"""
+
+
+def run(*args: str) -> Result:
+    return CliRunner().invoke(cli.main, list(args))
+
+
+def broken_parser(use_cache: bool) -> None:
+    raise RuntimeError("parser used")
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> pathlib.Path:
+    cache_home = tmp_path / "cache"
+    monkeypatch.setenv("XDG_CACHE_HOME", str(cache_home))
+    return cache_home
+
+
+def index(cache_home: pathlib.Path) -> list:
+    return list(
+        json.loads(
+            cache_home.joinpath("beancount-format", "formatted.json").read_text()
+        )
+    )
+
+
+def test_cache_hit_skips_parsing(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    file = tmp_path / "a.bean"
+    file.write_text(ledger())
+    assert run(str(file)).exit_code == 1
+    # formatted now, second run records it as clean
+    assert run(str(file)).exit_code == 0
+
+    monkeypatch.setattr(cli, "_get_parser", broken_parser)
+    result = run(str(file))
+    assert result.exit_code == 0, result.output
+    assert result.output == ""
+
+
+def test_cache_miss_on_changed_content(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    file = tmp_path / "a.bean"
+    file.write_text(ledger())
+    run(str(file))
+    run(str(file))
+
+    file.write_text(ledger())
+    monkeypatch.setattr(cli, "_get_parser", broken_parser)
+    result = run(str(file))
+    assert result.exit_code == 1
+    assert "parser used" in result.output
+
+
+def test_cache_invalidated_by_formatter_change(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    file = tmp_path / "a.bean"
+    file.write_text(ledger())
+    run(str(file))
+    run(str(file))
+
+    monkeypatch.setattr(cli, "_formatter_fingerprint", lambda: b"another formatter")
+    monkeypatch.setattr(cli, "_get_parser", broken_parser)
+    result = run(str(file))
+    assert result.exit_code == 1
+    assert "parser used" in result.output
+
+
+def test_cache_keeps_most_recently_used(
+    tmp_path: pathlib.Path, cache_home: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(cli, "MAX_CACHE_ENTRIES", 2)
+    files = []
+    for i in range(3):
+        file = tmp_path / f"{i}.bean"
+        file.write_text(ledger(f"Assets:Bank{i}"))
+        run(str(file))
+        run(str(file))
+        files.append(file)
+
+    assert len(index(cache_home)) == 2
+
+    monkeypatch.setattr(cli, "_get_parser", broken_parser)
+    # oldest entry is evicted, the others are still hits
+    assert run(str(files[0])).exit_code == 1
+    assert run(str(files[1])).exit_code == 0
+    assert run(str(files[2])).exit_code == 0
+
+
+def test_no_cache(
+    tmp_path: pathlib.Path, cache_home: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(cli, "_parser", None)
+    file = tmp_path / "a.bean"
+    file.write_text(ledger())
+    assert run("--no-cache", str(file)).exit_code == 1
+    assert run("--no-cache", str(file)).exit_code == 0
+    assert not cache_home.exists()
+
+
+def test_grammar_cache(
+    tmp_path: pathlib.Path, cache_home: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(cli, "_parser", None)
+    file = tmp_path / "a.bean"
+    file.write_text(ledger())
+    assert run(str(file)).exit_code == 1
+    assert cache_home.joinpath("beancount-format", "grammar.lark").is_file()
+
+
+def test_paths_are_printed_like_pathlib(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    tmp_path.joinpath("sub").mkdir()
+    tmp_path.joinpath("sub", "a.bean").write_text(ledger())
+    monkeypatch.chdir(tmp_path)
+    result = run("--no-cache", ".")
+    assert result.output == f"formatting {pathlib.Path('sub', 'a.bean')}\n"
+
+
+def test_each_file_is_formatted_once(tmp_path: pathlib.Path) -> None:
+    file = tmp_path / "a.bean"
+    file.write_text(ledger())
+    tmp_path.joinpath("link.bean").symlink_to(file)
+    tmp_path.joinpath("dir-link").symlink_to(tmp_path)
+    result = run("--no-cache", str(file), str(tmp_path), str(file))
+    assert result.output == f"formatting {file}\n"
+
+
+def write_ledgers(directory: pathlib.Path, count: int) -> typing.List[pathlib.Path]:
+    directory.mkdir()
+    files = []
+    for i in range(count):
+        file = directory / f"{i:02}.bean"
+        file.write_text(ledger(f"Assets:Bank{i}"))
+        files.append(file)
+    return files
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_format_files(tmp_path: pathlib.Path, jobs: str) -> None:
+    files = write_ledgers(tmp_path / "ledgers", 20)
+    expected = tmp_path / "expected.bean"
+    expected.write_text(ledger("Assets:Bank0"))
+    run("--no-cache", str(expected))
+
+    result = run("-j", jobs, *map(str, files))
+    assert result.exit_code == 1
+    assert result.output == "".join(f"formatting {file}\n" for file in files)
+    assert files[0].read_text() == expected.read_text()
+
+    # cached
+    assert run("-j", jobs, *map(str, files)).exit_code == 0
+    result = run("-j", jobs, *map(str, files))
+    assert result.exit_code == 0
+    assert result.output == ""
+
+
+def test_sequential_stops_at_failure(tmp_path: pathlib.Path) -> None:
+    files = write_ledgers(tmp_path / "ledgers", 20)
+    files[5].write_text("2020-01-01 open\n")
+
+    result = run("--no-cache", "-j", "1", *map(str, files))
+    assert result.exit_code == 1
+    assert result.output.startswith(
+        "".join(f"formatting {file}\n" for file in files[:5])
+        + f"failed to format file {files[5]}"
+    )
+    assert files[6].read_text() == ledger("Assets:Bank6")
+
+
+def test_pool_reports_every_written_file(tmp_path: pathlib.Path) -> None:
+    files = write_ledgers(tmp_path / "ledgers", 40)
+    files[5].write_text("2020-01-01 open\n")
+
+    result = run("--no-cache", "-j", "2", *map(str, files))
+    assert result.exit_code == 1
+    assert f"failed to format file {files[5]}" in result.output
+    for i, file in enumerate(files):
+        if i == 5:
+            continue
+        written = file.read_text() != ledger(f"Assets:Bank{i}")
+        assert written == (f"formatting {file}\n" in result.output), file